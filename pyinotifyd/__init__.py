@@ -25,16 +25,20 @@ __all__ = [
 
 import argparse
 import asyncio
+import importlib.machinery
+import importlib.util
 import logging
-import logging.handlers
+import os
 import pyinotify
+import re
 import signal
 import sys
 
 from pyinotify import ProcessEvent, ExcludeFilter
 
 from pyinotifyd._install import install, uninstall
-from pyinotifyd.scheduler import TaskScheduler, Cancel
+from pyinotifyd import scheduler as _scheduler_module
+from pyinotifyd.scheduler import TaskScheduler, Cancel, _combinable
 
 __version__ = "0.0.10"
 
@@ -45,6 +49,8 @@ def setLoglevel(loglevel, logname=None):
 
 
 def enableSyslog(loglevel=None, address="/dev/log", logname=None):
+    import logging.handlers
+
     logger = logging.getLogger(logname)
     syslog = logging.handlers.SysLogHandler(address=address)
     syslog.setFormatter(
@@ -55,16 +61,79 @@ def enableSyslog(loglevel=None, address="/dev/log", logname=None):
         logger.addHandler(syslog)
 
 
+# strong references to the tasks started by the daemon, the event loop
+# itself only keeps weak references
+_tasks = set()
+
+
+def _create_task(coro):
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+class _ExcludeFilter(ExcludeFilter):
+    def __init__(self, arg_lst):
+        super().__init__(arg_lst)
+
+        # match all regular expressions in a single pass
+        self._combined_re = None
+        patterns = [r.pattern for r in getattr(self, "_lregex", [])]
+        if _combinable(patterns):
+            try:
+                self._combined_re = re.compile(
+                    "|".join(f"(?:{p})" for p in patterns), re.UNICODE)
+            except re.error:
+                pass
+
+    def __call__(self, path):
+        if self._combined_re is None:
+            return super().__call__(path)
+
+        return self._combined_re.match(path) is not None
+
+
 class _SchedulerList:
-    def __init__(self, schedulers=[]):
-        if not isinstance(schedulers, list):
+    __slots__ = ("_schedulers", "_handlers", "_handler", "process_event")
+
+    def __init__(self, schedulers=None):
+        if schedulers is None:
+            schedulers = []
+        elif not isinstance(schedulers, list):
             schedulers = [schedulers]
 
-        self._schedulers = schedulers
+        self._schedulers = tuple(schedulers)
+        self._handlers = tuple(
+            _SchedulerList._handler_of(s) for s in schedulers)
+        if len(self._handlers) == 1:
+            self._handler = self._handlers[0]
+            self.process_event = self._process_event_single
+        else:
+            self._handler = None
+            self.process_event = self._process_event_multi
 
-    def process_event(self, event):
-        for scheduler in self._schedulers:
-            asyncio.create_task(scheduler.process_event(event))
+    @staticmethod
+    def _handler_of(scheduler):
+        # subclasses which override process_event() are dispatched through
+        # it, submit() would bypass the override
+        if isinstance(scheduler, TaskScheduler) and \
+                type(scheduler).process_event is not \
+                TaskScheduler.process_event:
+            return scheduler.process_event
+
+        return scheduler.submit
+
+    def _process_event_single(self, event):
+        job = self._handler(event)
+        if job is not None:
+            _create_task(job)
+
+    def _process_event_multi(self, event):
+        for handler in self._handlers:
+            job = handler(event)
+            if job is not None:
+                _create_task(job)
 
     def schedulers(self):
         return self._schedulers
@@ -75,14 +144,24 @@ class EventMap(ProcessEvent):
         **pyinotify.EventsCodes.OP_FLAGS,
         **pyinotify.EventsCodes.EVENT_FLAGS}
 
+    _no_default_flags = frozenset(["IN_IGNORED", "IN_Q_OVERFLOW"])
+
     def my_init(self, event_map=None, default_sched=None, exclude_filter=None,
                 logname="eventmap"):
         self._map = {}
+        self._handlers = {}
+        self._mask = 0
+        self._schedulers = None
         self._exclude_filter = None
 
         if default_sched is not None:
+            # share one scheduler list between all flags, events which do
+            # not belong to a path are only passed to explicitly mapped
+            # schedulers
+            scheduler_list = EventMap._scheduler_list(default_sched)
             for flag in EventMap.flags:
-                self.set(flag, default_sched)
+                if flag not in EventMap._no_default_flags:
+                    self._set_scheduler_list(flag, scheduler_list)
 
         if event_map is not None:
             assert isinstance(event_map, dict), \
@@ -93,25 +172,44 @@ class EventMap(ProcessEvent):
         self.set_exclude_filter(exclude_filter)
         self._log = logging.getLogger((logname or __name__))
 
-    def set_scheduler(self, flag, schedulers):
-        assert flag in EventMap.flags, \
-            f"event_map: invalid flag: {flag}"
-        if schedulers is not None:
-            if not isinstance(schedulers, list):
-                schedulers = [schedulers]
+    @staticmethod
+    def _scheduler_list(schedulers):
+        if schedulers is None:
+            return None
+
+        if not isinstance(schedulers, list):
+            schedulers = [schedulers]
+
+        instances = []
+        for scheduler in schedulers:
+            if isinstance(scheduler, (TaskScheduler, Cancel)):
+                instances.append(scheduler)
+            else:
+                instances.append(TaskScheduler(scheduler))
 
-            instances = []
-            for scheduler in schedulers:
-                if issubclass(type(scheduler), TaskScheduler) or \
-                        isinstance(scheduler, Cancel):
-                    instances.append(scheduler)
-                else:
-                    instances.append(TaskScheduler(scheduler))
+        return _SchedulerList(instances)
 
-            self._map[flag] = _SchedulerList(instances)
+    def _set_scheduler_list(self, flag, scheduler_list):
+        value = EventMap.flags[flag]
+        if scheduler_list is not None:
+            self._map[flag] = scheduler_list
+            self._handlers[value] = scheduler_list.process_event
+            self._mask |= value
+            self._schedulers = None
 
         elif flag in self._map:
             del self._map[flag]
+            del self._handlers[value]
+            self._mask &= ~value
+            self._schedulers = None
+
+    def set_scheduler(self, flag, schedulers):
+        assert flag in EventMap.flags, \
+            f"event_map: invalid flag: {flag}"
+        self._set_scheduler_list(flag, EventMap._scheduler_list(schedulers))
+
+    def mask(self):
+        return self._mask
 
     def set_exclude_filter(self, exclude_filter):
         if exclude_filter is None:
@@ -119,42 +217,66 @@ class EventMap(ProcessEvent):
             return
 
         if not isinstance(exclude_filter, ExcludeFilter):
-            self._exclude_filter = ExcludeFilter(exclude_filter)
+            self._exclude_filter = _ExcludeFilter(exclude_filter)
         else:
             self._exclude_filter = exclude_filter
 
     def process_default(self, event):
-        attrs = ""
-        for attr in [
-                "dir", "mask", "maskname", "pathname", "src_pathname", "wd"]:
-            value = getattr(event, attr, None)
-            if attr == "mask":
-                value = hex(value)
-            if value:
-                attrs += f", {attr}={value}"
-
-        self._log.debug(f"received event{attrs}")
-        maskname = event.maskname.split("|")[0]
-
-        if maskname not in self._map:
+        if self._log.isEnabledFor(logging.DEBUG):
+            attrs = ""
+            for attr in [
+                    "dir", "mask", "maskname", "pathname", "src_pathname",
+                    "wd"]:
+                value = getattr(event, attr, None)
+                if attr == "mask":
+                    value = hex(value)
+                if value:
+                    attrs += f", {attr}={value}"
+
+            self._log.debug(f"received event{attrs}")
+
+        # pyinotify only combines a single event flag with IN_ISDIR
+        handler = self._handlers.get(event.mask & ~pyinotify.IN_ISDIR)
+        if handler is None:
             return
 
-        if self._exclude_filter and self._exclude_filter(event.pathname):
-            self._log.debug(f"pathname {event.pathname} is excluded")
+        pathname = event.pathname
+        if self._exclude_filter and self._exclude_filter(pathname):
+            self._log.debug("pathname %s is excluded", pathname)
             return
 
-        self._map[maskname].process_event(event)
+        handler(event)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self._log.warning("inotify event queue overflowed, events are lost")
+        handler = self._handlers.get(pyinotify.IN_Q_OVERFLOW)
+        if handler is None:
+            return
+
+        # overflows are not bound to a watch and carry their mask only
+        attrs = vars(event)
+        for attr, value in [("dir", False), ("path", ""), ("name", ""),
+                            ("pathname", ""), ("wd", -1)]:
+            attrs.setdefault(attr, value)
+
+        handler(event)
 
     def schedulers(self):
-        schedulers = []
-        for scheduler_list in self._map.values():
-            schedulers.extend(
-                scheduler_list.schedulers())
+        if self._schedulers is None:
+            schedulers = []
+            for scheduler_list in self._map.values():
+                schedulers.extend(
+                    scheduler_list.schedulers())
+
+            self._schedulers = tuple(dict.fromkeys(schedulers))
 
-        return list(set(schedulers))
+        return self._schedulers
 
 
 class Watch:
+    __slots__ = ("_path", "_event_map", "_rec", "_auto_add",
+                 "_exclude_filter", "_log")
+
     def __init__(self, path, event_map=None, default_sched=None,
                  rec=False, auto_add=False, exclude_filter=None,
                  logname="watch"):
@@ -176,7 +298,7 @@ class Watch:
         self._exclude_filter = None
         if exclude_filter:
             if not isinstance(exclude_filter, ExcludeFilter):
-                self._exclude_filter = ExcludeFilter(exclude_filter)
+                self._exclude_filter = _ExcludeFilter(exclude_filter)
             else:
                 self._exclude_filter = exclude_filter
 
@@ -185,9 +307,6 @@ class Watch:
         self._path = path
         self._rec = rec
         self._auto_add = auto_add
-
-        self._watch_manager = pyinotify.WatchManager()
-        self._notifier = None
         self._log = logging.getLogger(logname)
 
     def path(self):
@@ -196,42 +315,185 @@ class Watch:
     def event_map(self):
         return self._event_map
 
-    def start(self):
-        self._watch_manager.add_watch(self._path, pyinotify.ALL_EVENTS,
-                                      rec=self._rec, auto_add=self._auto_add,
-                                      exclude_filter=self._exclude_filter,
-                                      do_glob=True)
+    def auto_add(self):
+        return self._auto_add
 
-        self._notifier = pyinotify.AsyncioNotifier(
-            self._watch_manager, asyncio.get_event_loop(), default_proc_fun=self._event_map)
+    def excluded(self, path):
+        return self._exclude_filter is not None and \
+            self._exclude_filter(path)
 
-    def stop(self):
-        self._notifier.stop()
+    def mask(self):
+        mask = self._event_map.mask()
+        if not mask:
+            return 0
 
-        self._notifier = None
+        if self._auto_add:
+            # pyinotify needs these events to add watches on new directories
+            mask |= pyinotify.IN_CREATE
+
+        if self._rec or self._auto_add:
+            # pyinotify needs these events to update the paths of watched
+            # sub-directories which are moved, unmapped events are dropped
+            # by the event map
+            mask |= pyinotify.IN_MOVE_SELF | pyinotify.IN_MOVED_FROM | \
+                pyinotify.IN_MOVED_TO
+
+        if mask & pyinotify.IN_MOVED_TO:
+            # src_pathname of IN_MOVED_TO events requires IN_MOVED_FROM
+            mask |= pyinotify.IN_MOVED_FROM
+
+        return mask
+
+    def add_watch(self, watch_manager, proc_fun=None):
+        mask = self.mask()
+        if not mask:
+            self._log.warning(
+                f"no events mapped, skip watch on '{self._path}'")
+            return {}
+
+        if proc_fun is None:
+            proc_fun = self._event_map
+
+        # inotify returns the existing watch descriptor if a path is watched
+        # more than once, IN_MASK_ADD extends its mask instead of replacing
+        return watch_manager.add_watch(self._path,
+                                       mask | pyinotify.IN_MASK_ADD,
+                                       proc_fun=proc_fun,
+                                       rec=self._rec,
+                                       auto_add=self._auto_add,
+                                       exclude_filter=self._exclude_filter,
+                                       do_glob=True)
+
+
+class _WatchDispatcher:
+    __slots__ = ("_watch_manager", "_watches", "_event_maps",
+                 "_overflow_maps")
+
+    def __init__(self, watch_manager):
+        self._watch_manager = watch_manager
+        # watch descriptor -> watches which requested the events of its path
+        self._watches = {}
+        self._event_maps = {}
+        self._overflow_maps = ()
+
+    def _set_watches(self, wd, watches):
+        self._watches[wd] = watches
+        event_maps = tuple(dict.fromkeys(w.event_map() for w in watches))
+        self._event_maps[wd] = event_maps
+        return event_maps
+
+    def add_watch(self, watch):
+        for wd in watch.add_watch(self._watch_manager, self).values():
+            if wd < 0:
+                continue
+
+            watches = self._watches.get(wd, ())
+            if watch in watches:
+                continue
+
+            watches += (watch,)
+            self._set_watches(wd, watches)
+            if len(watches) == 1:
+                continue
+
+            # pyinotify keeps the attributes of the last add_watch() call,
+            # new sub-directories have to be watched for all watches
+            watch_ = self._watch_manager.get_watch(wd)
+            for w in watches:
+                watch_.mask |= w.mask()
+
+            auto_add = tuple(w for w in watches if w.auto_add())
+            watch_.auto_add = bool(auto_add)
+            if auto_add:
+                watch_.exclude_filter = lambda path, auto_add=auto_add: all(
+                    w.excluded(path) for w in auto_add)
+
+        event_map = watch.event_map()
+        if event_map.mask() & pyinotify.IN_Q_OVERFLOW and \
+                event_map not in self._overflow_maps:
+            self._overflow_maps += (event_map,)
+
+    def _resolve(self, wd):
+        # watches added by pyinotify on new sub-directories (auto_add)
+        # belong to the auto_add watches of their parent directory
+        path = self._watch_manager.get_path(wd)
+        if path is None:
+            return ()
+
+        watches = ()
+        parent_wd = self._watch_manager.get_wd(os.path.dirname(path))
+        if parent_wd is not None and parent_wd != wd:
+            if parent_wd not in self._watches:
+                self._resolve(parent_wd)
+
+            watches = tuple(
+                w for w in self._watches.get(parent_wd, ())
+                if w.auto_add() and not w.excluded(path))
+
+        return self._set_watches(wd, watches)
+
+    def __call__(self, event):
+        mask = event.mask
+        if mask & pyinotify.IN_Q_OVERFLOW:
+            # overflows are not bound to a watch descriptor
+            for event_map in self._overflow_maps:
+                event_map(event)
+
+            return
+
+        wd = event.wd
+        event_maps = self._event_maps.get(wd)
+        if event_maps is None:
+            event_maps = self._resolve(wd)
+
+        for event_map in event_maps:
+            event_map(event)
+
+        if mask & pyinotify.IN_IGNORED:
+            # the watch is removed, inotify may reuse its descriptor
+            self._watches.pop(wd, None)
+            self._event_maps.pop(wd, None)
 
 
 class Pyinotifyd:
+    __slots__ = ("_watches", "_shutdown_timeout", "_watch_manager",
+                 "_notifier", "_log")
+
     name = "pyinotifyd"
 
-    def __init__(self, watches=[], shutdown_timeout=30, logname="daemon"):
-        self.set_watches(watches)
+    def __init__(self, watches=None, shutdown_timeout=30, logname="daemon"):
+        self.set_watches(watches or [])
         self.set_shutdown_timeout(shutdown_timeout)
+        self._watch_manager = None
+        self._notifier = None
         logname = (logname or __name__)
 
         self._log = logging.getLogger(logname)
 
     @staticmethod
     def from_cfg_file(config_file):
-        config = {}
         name = Pyinotifyd.name
-        exec("from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL",
-            config)
-        exec(f"from {name} import Pyinotifyd, Watch", config)
-        exec(f"from {name} import setLoglevel, enableSyslog", config)
-        exec(f"from {name}.scheduler import *", config)
-        with open(config_file, "r") as fh:
-            exec(fh.read(), config)
+        # load the config file as a module to benefit from the bytecode
+        # cache, also if the file does not end with .py
+        loader = importlib.machinery.SourceFileLoader(
+            f"{name}_config", config_file)
+        spec = importlib.util.spec_from_file_location(
+            loader.name, config_file, loader=loader)
+        module = importlib.util.module_from_spec(spec)
+        config = vars(module)
+        for level in ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]:
+            config[level] = getattr(logging, level)
+
+        config.update({
+            "Pyinotifyd": Pyinotifyd,
+            "Watch": Watch,
+            "EventMap": EventMap,
+            "setLoglevel": setLoglevel,
+            "enableSyslog": enableSyslog})
+        for attr in _scheduler_module.__all__:
+            config[attr] = getattr(_scheduler_module, attr)
+
+        loader.exec_module(module)
         instance = config[f"{name}"]
         assert isinstance(instance, Pyinotifyd), \
             f"{name}: expected {type(Pyinotifyd)}, " \
@@ -267,17 +529,32 @@ class Pyinotifyd:
         schedulers = []
         for w in self._watches:
             schedulers.extend(w.event_map().schedulers())
-        return list(set(schedulers))
+        return list(dict.fromkeys(schedulers))
 
-    def start(self):
+    def start(self, loop=None):
         if len(self._watches) == 0:
             self._log.warning(
                 "no watches configured, the daemon will not do anything")
 
+        self._watch_manager = pyinotify.WatchManager()
+        # all watches share one inotify instance, the dispatcher passes the
+        # events of each watch descriptor to the event maps of its watches,
+        # add the watches one after another and in the configured order
+        dispatcher = _WatchDispatcher(self._watch_manager)
+        for watch in self._watches:
+            dispatcher.add_watch(watch)
+
         for watch in self._watches:
             self._log.info(
                 f"start listening for inotify events on '{watch.path()}'")
-            watch.start()
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        # events without a watch (IN_Q_OVERFLOW) are passed to the
+        # default_proc_fun
+        self._notifier = pyinotify.AsyncioNotifier(
+            self._watch_manager, loop, default_proc_fun=dispatcher)
 
     def pause(self):
         for scheduler in self.schedulers():
@@ -286,24 +563,30 @@ class Pyinotifyd:
     async def shutdown(self):
         schedulers = self.schedulers()
 
-        tasks = [s.shutdown(self._shutdown_timeout) for s in set(schedulers)]
+        tasks = [s.shutdown(self._shutdown_timeout) for s in schedulers]
         if tasks:
             await asyncio.gather(*tasks)
 
         for watch in self._watches:
             self._log.debug(
                 f"stop listening for inotify events on '{watch.path()}'")
-            watch.stop()
+
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+            self._watch_manager = None
 
 
 class DaemonInstance:
+    __slots__ = ("_instance", "_shutdown", "_log")
+
     def __init__(self, instance, logname="daemon"):
         self._instance = instance
         self._shutdown = False
         self._log = logging.getLogger(logname)
 
-    def start(self):
-        self._instance.start()
+    def start(self, loop=None):
+        self._instance.start(loop)
 
     async def shutdown(self, signame):
         if self._shutdown:
@@ -317,20 +600,21 @@ class DaemonInstance:
         try:
             await self._instance.shutdown()
 
-            pending = [t for t in asyncio.all_tasks()
-                       if t is not asyncio.current_task()]
-
-            for task in pending:
-                task.cancel()
-
-            try:
-                await asyncio.gather(*pending)
-            except asyncio.CancelledError:
-                pass
+            current_task = asyncio.current_task()
+            # asyncio.wait() builds a set anyway, cancel and collect the
+            # pending tasks in a single pass
+            pending = set()
+            for task in _tasks:
+                if task is not current_task and not task.done():
+                    task.cancel()
+                    pending.add(task)
+
+            if pending:
+                await asyncio.wait(pending)
         except Exception as e:
             self._log.exception(f"error during shutdown: {e}")
 
-        asyncio.get_event_loop().stop()
+        asyncio.get_running_loop().stop()
         self._shutdown = False
         self._log.info("shutdown complete")
 
@@ -353,12 +637,16 @@ class DaemonInstance:
             old_instance = self._instance
 
             old_instance.pause()
-            instance.start()
-            asyncio.create_task(old_instance.shutdown())
+            instance.start(asyncio.get_running_loop())
+            _create_task(old_instance.shutdown())
 
             self._instance = instance
 
 
+def _signal_handler(loop, coro_func, *args):
+    loop.create_task(coro_func(*args))
+
+
 def main():
     name = Pyinotifyd.name
 
@@ -447,6 +735,15 @@ def main():
 
     if args.configtest:
         logging.info("config file ok")
+        # make sure the bytecode cache of the config file is up to date,
+        # even if writing bytecode is disabled
+        import py_compile
+
+        try:
+            py_compile.compile(args.config, doraise=True)
+        except (OSError, py_compile.PyCompileError) as e:
+            logging.warning(f"unable to compile config file: {e}")
+
         sys.exit(0)
 
     if args.debug:
@@ -456,18 +753,26 @@ def main():
         f"%(asctime)s - {name}/%(name)s - %(levelname)s - %(message)s")
     ch.setFormatter(formatter)
 
-    loop = asyncio.get_event_loop()
+    try:
+        import uvloop
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+
+    asyncio.set_event_loop(loop)
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
+
     loop.add_signal_handler(
-        signal.SIGTERM, lambda: loop.create_task(
-            daemon.shutdown("SIGTERM")))
+        signal.SIGTERM, _signal_handler, loop, daemon.shutdown, "SIGTERM")
     loop.add_signal_handler(
-        signal.SIGINT, lambda: loop.create_task(
-            daemon.shutdown("SIGINT")))
+        signal.SIGINT, _signal_handler, loop, daemon.shutdown, "SIGINT")
     loop.add_signal_handler(
-        signal.SIGHUP, lambda: loop.create_task(
-            daemon.reload("SIGHUP", args.config, args.debug)))
+        signal.SIGHUP, _signal_handler, loop, daemon.reload, "SIGHUP",
+        args.config, args.debug)
 
-    daemon.start()
+    daemon.start(loop)
     loop.run_forever()
     loop.close()
 
@@ -18,19 +18,28 @@ import filecmp
 import logging
 import os
 import shutil
+import stat
 import sys
 
+from functools import lru_cache
+
 
 SYSTEMD_PATHS = ["/lib/systemd/system", "/usr/lib/systemd/system"]
 
 OPENRC = "/sbin/openrc"
 
 
-def _systemd_files(pkg_dir, name):
+@lru_cache(maxsize=None)
+def _systemd_path():
     for path in SYSTEMD_PATHS:
         if os.path.isdir(path):
-            break
+            return path
+
+    return None
 
+
+def _systemd_files(pkg_dir, name):
+    path = _systemd_path() or SYSTEMD_PATHS[-1]
     return [
         (f"{pkg_dir}/misc/systemd/{name}.service",
             f"{path}/{name}.service", True)]
@@ -49,8 +58,13 @@ def _config_files(pkg_dir, name):
 
 def _install_files(files):
     for src, dst, force in files:
-        if os.path.exists(dst):
-            if os.path.isdir(dst):
+        try:
+            dst_stat = os.stat(dst)
+        except OSError:
+            dst_stat = None
+
+        if dst_stat is not None:
+            if stat.S_ISDIR(dst_stat.st_mode):
                 logging.error(
                     " => unable to copy file, destination path is a directory")
                 continue
@@ -67,7 +81,10 @@ def _install_files(files):
 
 def _uninstall_files(files):
     for src, dst, force in files:
-        if not os.path.isfile(dst):
+        try:
+            if not stat.S_ISREG(os.stat(dst).st_mode):
+                continue
+        except OSError:
             continue
 
         if not force and not filecmp.cmp(src, dst, shallow=True):
@@ -118,11 +135,7 @@ def _check_root():
 
 
 def _check_systemd():
-    for path in SYSTEMD_PATHS:
-        systemd = os.path.isdir(path)
-        if systemd:
-            break
-
+    systemd = _systemd_path() is not None
     if systemd:
         logging.info("systemd detected")
 
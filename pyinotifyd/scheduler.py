@@ -20,17 +20,195 @@ __all__ = [
     "FileManagerScheduler"]
 
 import asyncio
+import ctypes
+import errno
+import grp
 import logging
 import os
+import pwd
 import re
 import shutil
+import signal
+import stat
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from inspect import iscoroutinefunction
+from itertools import count
 from shlex import quote as shell_quote
+from string import Formatter
 from uuid import uuid4
 
 
+# numbered or named back references and conditional group references
+# change their meaning if the pattern is embedded into a larger expression
+_BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+# global inline flags apply to the whole expression they are embedded in
+_GLOBAL_FLAGS_RE = re.compile(r"\(\?[aiLmsux]+\)")
+
+_NAMED_GROUP_RE = re.compile(r"(?<!\\)\(\?P<")
+
+
+def _combinable(patterns):
+    # regular expressions may be combined into a single alternation unless
+    # they contain back references or global inline flags
+    return bool(patterns) and not any(
+        _BACKREF_RE.search(p) or _GLOBAL_FLAGS_RE.search(p)
+        for p in patterns)
+
+
+# commands consisting only of these characters (apart from placeholders)
+# are split into the same arguments by the shell and by str.split()
+_SIMPLE_CMD_RE = re.compile(r"[\w \t+=.,:/@%^-]*")
+
+_PLACEHOLDER_RE = re.compile(r"\{(maskname|pathname|src_pathname)\}")
+
+# POSIX special and regular builtins and the common builtins of /bin/sh,
+# which may behave differently than executables of the same name in PATH
+_SHELL_BUILTINS = frozenset([
+    ".", ":", "[", "alias", "bg", "break", "cd", "command", "continue",
+    "echo", "eval", "exec", "exit", "export", "false", "fc", "fg",
+    "getopts", "hash", "jobs", "kill", "newgrp", "printf", "pwd", "read",
+    "readonly", "return", "set", "shift", "test", "times", "trap", "true",
+    "type", "ulimit", "umask", "unalias", "unset", "wait"])
+
+# errors of copy_file_range() and sendfile() which indicate that the
+# syscall is not supported for the given files
+_COPY_FALLBACK_ERRNOS = frozenset([
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.ENOTSUP, errno.EBADF, errno.ETXTBSY])
+
+_COPY_CHUNK_SIZE = 1 << 30
+
+_COPY_BUFSIZE = 1 << 20
+
+_AT_FDCWD = -100
+
+_RENAME_NOREPLACE = 1
+
+
+def _copyfile_fd(infd, outfd, size):
+    # let the kernel copy the data, copy_file_range() may even avoid the
+    # copy altogether (reflinks, server-side copy on NFS)
+    total = 0
+    for name in ["copy_file_range", "sendfile"]:
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+
+        try:
+            while True:
+                if name == "sendfile":
+                    copied = func(outfd, infd, None, _COPY_CHUNK_SIZE)
+                else:
+                    copied = func(infd, outfd, _COPY_CHUNK_SIZE)
+
+                if copied:
+                    total += copied
+                elif total or not size:
+                    return
+                else:
+                    # some filesystems report no data at all, try the
+                    # next method
+                    break
+        except OSError as e:
+            # the file offsets are updated by both syscalls, the next
+            # method continues where the failed one stopped
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    # reuse a single large buffer, small buffers limit the throughput
+    # especially on network filesystems
+    buf = bytearray(_COPY_BUFSIZE)
+    view = memoryview(buf)
+    while True:
+        length = os.readv(infd, [buf])
+        if not length:
+            return
+
+        written = 0
+        while written < length:
+            written += os.write(outfd, view[written:length])
+
+
+@lru_cache(maxsize=None)
+def _renameat2():
+    try:
+        func = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+
+    func.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p,
+        ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+
+def _rename_noreplace(src, dst):
+    # let the kernel refuse to replace an existing destination, which
+    # saves a stat() and is free of races
+    renameat2 = _renameat2()
+    if renameat2 is not None:
+        if renameat2(_AT_FDCWD, os.fsencode(src), _AT_FDCWD,
+                     os.fsencode(dst), _RENAME_NOREPLACE) == 0:
+            return
+
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err), src, None, dst)
+
+    # renameat2() is not supported by the libc, kernel or filesystem
+    if os.path.lexists(dst):
+        raise FileExistsError(
+            errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+
+    os.rename(src, dst)
+
+
+def _copy2(src, dst, *, follow_symlinks=True):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    src_stat = os.stat(src, follow_symlinks=follow_symlinks)
+    if not stat.S_ISREG(src_stat.st_mode):
+        # symlinks and special files are handled by shutil
+        return shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+
+    # the same checks as shutil.copyfile(), opening dst truncates src if
+    # both are the same file
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        pass
+    else:
+        if os.path.samestat(src_stat, dst_stat):
+            raise shutil.SameFileError(
+                f"{src!r} and {dst!r} are the same file")
+
+        if stat.S_ISFIFO(dst_stat.st_mode):
+            raise shutil.SpecialFileError(f"`{dst}` is a named pipe")
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        _copyfile_fd(fsrc.fileno(), fdst.fileno(), src_stat.st_size)
+
+    shutil.copystat(src, dst, follow_symlinks=follow_symlinks)
+    return dst
+
+
 class SchedulerLogger(logging.LoggerAdapter):
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            # merge args before process() appends the (unescaped) event
+            # details to the message
+            if args:
+                msg = msg % args
+
+            msg, kwargs = self.process(msg, kwargs)
+            self.logger.log(level, msg, **kwargs)
+
     def process(self, msg, kwargs):
         if "event" in self.extra:
             event = self.extra["event"]
@@ -46,13 +224,21 @@ class SchedulerLogger(logging.LoggerAdapter):
 class TaskScheduler:
 
     class TaskState:
-        def __init__(self, task_id=None, task=None, cancelable=True):
-            self.id = task_id or str(uuid4())
+        __slots__ = ("id", "task", "cancelable", "event", "deadline")
+
+        def __init__(self, task_id, task=None, cancelable=True, event=None,
+                     deadline=0):
+            self.id = task_id
             self.task = task
             self.cancelable = cancelable
+            self.event = event
+            self.deadline = deadline
 
     def __init__(self, job, files=True, dirs=False, delay=0, logname="sched",
-                 global_vars={}, singlejob=False):
+                 global_vars=None, singlejob=False):
+        if global_vars is None:
+            global_vars = {}
+
         assert iscoroutinefunction(job), \
             f"job: expected coroutine, got {type(job)}"
         assert isinstance(files, bool), \
@@ -72,6 +258,7 @@ class TaskScheduler:
         self._globals = global_vars
         self._singlejob = singlejob
         self._tasks = {}
+        self._next_task_id = count(1).__next__
         self._pause = False
 
     def pause(self):
@@ -80,7 +267,13 @@ class TaskScheduler:
 
     async def shutdown(self, timeout=None):
         self._pause = True
-        pending = [t.task for t in self._tasks.values()]
+        if any(t.task is None for t in self._tasks.values()):
+            # tasks created for submit() register themselves in their task
+            # state on their first step, let them run up to that point
+            await asyncio.sleep(0)
+
+        pending = [
+            t.task for t in self._tasks.values() if t.task is not None]
         if pending:
             if timeout is None:
                 self._log.info(
@@ -97,95 +290,118 @@ class TaskScheduler:
                     f"cancel {len(pending)} remaining task(s)")
                 for task in pending:
                     task.cancel()
-                try:
-                    await asyncio.gather(*pending)
-                except asyncio.CancelledError:
-                    pass
+                await asyncio.wait(pending)
             else:
                 self._log.info("all remainig tasks completed")
 
     def taskindex(self, event):
         return "singlejob" if self._singlejob else event.pathname
 
-    async def _run_job(self, event, task_state, restart=False):
-        logger = SchedulerLogger(self._log, {
-            "event": event,
-            "id": task_state.id})
+    async def _run_job(self, task_state):
+        if self._tasks.get(self.taskindex(task_state.event)) is not task_state:
+            # cancelled before the task was started
+            return
 
+        # the task and the delay run within the current task, cancelling it
+        # during the delay cancels the scheduled task
+        task_state.task = asyncio.current_task()
         if self._delay > 0:
-            task_state.task = asyncio.create_task(
-                asyncio.sleep(self._delay))
-            try:
-                if restart:
-                    prefix = "re-"
-                else:
-                    prefix = ""
-
-                logger.info(f"{prefix}schedule task, delay={self._delay}")
+            logger = SchedulerLogger(self._log, {
+                "event": task_state.event,
+                "id": task_state.id})
+            logger.info("schedule task, delay=%s", self._delay)
 
-                await task_state.task
+            # further events move the deadline instead of restarting the
+            # task, sleep until the latest deadline is reached
+            loop = asyncio.get_running_loop()
+            try:
+                remaining = task_state.deadline - loop.time()
+                while remaining > 0:
+                    await asyncio.sleep(remaining)
+                    remaining = task_state.deadline - loop.time()
             except asyncio.CancelledError:
                 return
 
+        event = task_state.event
+        logger = SchedulerLogger(self._log, {
+            "event": event,
+            "id": task_state.id})
+
         logger.info("start task")
         if self._globals:
             local_vars = {"self": self,
                           "event": event,
                           "task_id": task_state.id}
-            task_state.task = asyncio.create_task(
-                eval("self._job(event, task_id)", self._globals, local_vars))
+            job = eval("self._job(event, task_id)", self._globals, local_vars)
 
         else:
-            task_state.task = asyncio.create_task(
-                self._job(event, task_state.id))
+            job = self._job(event, task_state.id)
 
         try:
             task_state.cancelable = False
-            await task_state.task
+            await job
         except asyncio.CancelledError:
             logger.warning("ongoing task cancelled")
         else:
             logger.info("task finished")
         finally:
-            task_index = self.taskindex(event)
-            del self._tasks[task_index]
+            self._tasks.pop(self.taskindex(event), None)
 
-    async def process_event(self, event):
-        if not ((not event.dir and self._files) or
-                (event.dir and self._dirs)):
-            return
+    def submit(self, event):
+        # the bookkeeping is done synchronously, a coroutine is returned
+        # only if a new task has to be started
+        is_dir = event.dir
+        if not ((not is_dir and self._files) or (is_dir and self._dirs)):
+            return None
 
-        restart = False
+        deadline = asyncio.get_running_loop().time() + self._delay
         task_index = self.taskindex(event)
-        try:
-            task_state = self._tasks[task_index]
-        except KeyError:
-            task_state = TaskScheduler.TaskState()
+        task_state = self._tasks.get(task_index)
+        if task_state is None:
+            if self._pause:
+                return None
+
+            task_state = TaskScheduler.TaskState(
+                self._next_task_id(), event=event, deadline=deadline)
             self._tasks[task_index] = task_state
         else:
             logger = SchedulerLogger(self._log, {
                 "event": event,
                 "id": task_state.id})
 
-            if task_state.cancelable:
-                task_state.task.cancel()
-                if not self._pause:
-                    restart = True
-                else:
-                    logger.info("scheduled task cancelled")
-
-            else:
+            if not task_state.cancelable:
                 logger.warning("skip event due to ongoing task")
-                return
+                return None
 
-        if not self._pause:
-            await self._run_job(event, task_state, restart)
+            if self._pause:
+                if task_state.task is not None:
+                    task_state.task.cancel()
 
-    async def process_cancel_event(self, event):
-        try:
-            task_index = self.taskindex(event)
-            task_state = self._tasks[task_index]
-        except KeyError:
+                logger.info("scheduled task cancelled")
+                return None
+
+            task_state.event = event
+            task_state.deadline = deadline
+            task = task_state.task
+            if task is None or not task.done():
+                # the scheduled task is still waiting, let it run later
+                # with the latest event instead of restarting it
+                if self._delay > 0:
+                    logger.info("re-schedule task, delay=%s", self._delay)
+
+                return None
+
+        return self._run_job(task_state)
+
+    async def process_event(self, event):
+        job = self.submit(event)
+        if job is not None:
+            await job
+
+    def submit_cancel(self, event):
+        task_index = self.taskindex(event)
+        task_state = self._tasks.get(task_index)
+        if task_state is None:
             return
 
         logger = SchedulerLogger(self._log, {
@@ -193,14 +409,19 @@ class TaskScheduler:
             "id": task_state.id})
 
         if task_state.cancelable:
-            task_state.task.cancel()
+            del self._tasks[task_index]
+            if task_state.task is not None:
+                task_state.task.cancel()
+
             logger.info("scheduled task cancelled")
             task_state.task = None
             logger.info(f"{task_index}")
-            del self._tasks[task_index]
         else:
             logger.warning("skip event due to ongoing task")
 
+    async def process_cancel_event(self, event):
+        self.submit_cancel(event)
+
 
 class Cancel:
     def __init__(self, task, *args, **kwargs):
@@ -208,6 +429,7 @@ class Cancel:
             f"task: expected {type(TaskScheduler)}, got {type(task)}"
 
         setattr(self, "process_event", task.process_cancel_event)
+        setattr(self, "submit", task.submit_cancel)
 
     def pause(self):
         pass
@@ -217,36 +439,176 @@ class Cancel:
 
 
 class ShellScheduler(TaskScheduler):
-    def __init__(self, cmd, job=None, *args, **kwargs):
+    placeholders = ["maskname", "pathname", "src_pathname"]
+
+    def __init__(self, cmd, job=None, *args, persistent=False, **kwargs):
         super().__init__(*args, **kwargs, job=self._shell_job)
 
         assert isinstance(cmd, str), \
             f"cmd: expected {type('')}, got {type(cmd)}"
+        assert isinstance(persistent, bool), \
+            f"persistent: expected {type(bool)}, got {type(persistent)}"
 
         self._cmd = cmd
+        self._persistent = persistent
+        self._shell = None
+        self._shell_lock = None
+        self._shell_token = f"__{self.__class__.__name__}_{uuid4().hex}__"
+        self._placeholders = [
+            p for p in ShellScheduler.placeholders if f"{{{p}}}" in cmd]
+        self._format_map = None
+
+        # str.format_map() replaces all placeholders in a single pass, but
+        # it may only be used if cmd contains no other curly braces
+        try:
+            fields = list(Formatter().parse(cmd))
+        except ValueError:
+            fields = None
+
+        if fields is not None and all(
+                "{" not in literal and "}" not in literal and (
+                    field is None or (
+                        field in ShellScheduler.placeholders and
+                        not spec and conversion is None))
+                for literal, field, spec, conversion in fields):
+            self._format_map = cmd.format_map
+
+        # execute simple commands directly, without starting a shell
+        self._argv = None
+        if not persistent and _SIMPLE_CMD_RE.fullmatch(
+                _PLACEHOLDER_RE.sub("", cmd)):
+            argv = cmd.split()
+            if argv and "=" not in argv[0] and "{" not in argv[0] and \
+                    argv[0] not in _SHELL_BUILTINS and \
+                    shutil.which(argv[0]) is not None:
+                self._argv = argv
 
     async def _shell_job(self, event, task_id):
-        maskname = event.maskname.split("|", 1)[0]
-        if hasattr(event, "src_pathname"):
-            src_pathname = event.src_pathname
-        else:
-            src_pathname = ""
+        # only compute the values of placeholders which are used in cmd
+        values = {}
+        for placeholder in self._placeholders:
+            if placeholder == "maskname":
+                value = event.maskname.partition("|")[0]
+            elif placeholder == "pathname":
+                value = event.pathname
+            else:
+                value = getattr(event, "src_pathname", "")
 
-        cmd = self._cmd.replace("{maskname}", shell_quote(maskname)).replace(
-            "{pathname}", shell_quote(event.pathname)).replace(
-                "{src_pathname}", shell_quote(src_pathname))
+            values[placeholder] = value
 
         logger = SchedulerLogger(self._log, {
             "event": event,
             "id": task_id})
 
-        logger.info(f"execute shell command, cmd={cmd}")
+        if self._argv is not None:
+            argv = [
+                arg.format_map(values) if "{" in arg else arg
+                for arg in self._argv]
+            logger.info("execute command, argv=%s", argv)
+            try:
+                proc = await asyncio.create_subprocess_exec(*argv)
+                await proc.communicate()
+            except OSError as e:
+                if e.errno != errno.ENOEXEC:
+                    logger.error(e)
+                    return
+
+                # scripts without a shebang line are only run by the shell,
+                # execute cmd in a shell from now on
+                logger.debug("%s, fall back to shell", e)
+                self._argv = None
+            except Exception as e:
+                logger.error(e)
+                return
+            else:
+                return
+
+        for placeholder, value in values.items():
+            values[placeholder] = shell_quote(value)
+
+        if not values:
+            cmd = self._cmd
+        elif self._format_map is not None:
+            cmd = self._format_map(values)
+        else:
+            cmd = _PLACEHOLDER_RE.sub(
+                lambda m: values[m.group(1)], self._cmd)
+
+        logger.info("execute shell command, cmd=%s", cmd)
         try:
-            proc = await asyncio.create_subprocess_shell(cmd)
-            await proc.communicate()
+            if self._persistent:
+                await self._run_in_shell(cmd)
+            else:
+                proc = await asyncio.create_subprocess_shell(cmd)
+                await proc.communicate()
         except Exception as e:
             logger.error(e)
 
+    async def _run_in_shell(self, cmd):
+        if self._shell_lock is None:
+            self._shell_lock = asyncio.Lock()
+
+        async with self._shell_lock:
+            if self._shell is None or self._shell.returncode is not None:
+                # start the shell in its own process group, killing the
+                # shell also kills the running command
+                self._shell = await asyncio.create_subprocess_exec(
+                    "/bin/sh", stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE, start_new_session=True)
+
+            shell = self._shell
+            token = self._shell_token
+            try:
+                shell.stdin.write(
+                    f"{{ {cmd}\n}} </dev/null\nprintf '%s\\n' {token}\n"
+                    .encode())
+                await shell.stdin.drain()
+
+                # forward the output of cmd until the token is printed
+                while True:
+                    line = await shell.stdout.readline()
+                    if not line:
+                        raise RuntimeError(
+                            "persistent shell exited unexpectedly")
+
+                    output, found, _ = line.partition(token.encode())
+                    if output:
+                        sys.stdout.buffer.write(output)
+                        sys.stdout.flush()
+
+                    if found:
+                        break
+            except BaseException:
+                # the token of cmd is left unread, the next command would
+                # return on it, start a new shell instead
+                if self._shell is shell:
+                    self._kill_shell()
+
+                raise
+
+    def _kill_shell(self):
+        shell = self._shell
+        self._shell = None
+        try:
+            os.killpg(shell.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        return shell
+
+    async def shutdown(self, timeout=None):
+        await super().shutdown(timeout)
+
+        shell = self._shell
+        if shell is not None and shell.returncode is None:
+            shell.stdin.close()
+            try:
+                await asyncio.wait_for(shell.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._log.warning(
+                    "shutdown timeout exceeded, kill persistent shell")
+                await self._kill_shell().wait()
+
 
 class FileManagerRule:
     valid_actions = ["copy", "move", "delete"]
@@ -279,20 +641,35 @@ class FileManagerRule:
         self.action = action
         self.src_re = re.compile(src_re)
         self.dst_re = dst_re
+
+        # parse dst_re once, this reports invalid group references when the
+        # config is loaded and the re module caches the parsed template
+        self.src_re.sub(dst_re, "")
         self.auto_create = auto_create
         self.overwrite = overwrite
         self.dirmode = dirmode
         self.filemode = filemode
         self.user = user
         self.group = group
+        self.uid = -1 if user is None else pwd.getpwnam(user).pw_uid
+        self.gid = -1 if group is None else grp.getgrnam(group).gr_gid
         self.rec = rec
 
 
 class FileManagerScheduler(TaskScheduler):
-    def __init__(self, rules, job=None, *args, **kwargs):
+    def __init__(self, rules, job=None, *args, max_workers=None, **kwargs):
         super().__init__(
             *args, **kwargs, job=self._manager_job, singlejob=False)
 
+        assert max_workers is None or isinstance(max_workers, int), \
+            f"max_workers: expected {type(int)}, got {type(max_workers)}"
+
+        # run blocking filesystem operations in a dedicated thread pool
+        # if max_workers is set, otherwise in the default executor
+        self._executor = None
+        if max_workers is not None:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
         if not isinstance(rules, list):
             rules = [rules]
 
@@ -301,77 +678,164 @@ class FileManagerScheduler(TaskScheduler):
                 f"rules: expected {type(FileManagerRule)}, got {type(rule)}"
 
         self._rules = rules
+        self._rules_re = None
+        self._rules_by_group = {}
+
+        patterns = [r.src_re.pattern for r in rules]
+        if _combinable(patterns):
+            # prefix named groups with the rule index, rules commonly use
+            # the same group names
+            patterns = [
+                _NAMED_GROUP_RE.sub(f"(?P<_rule{i}_", p)
+                for i, p in enumerate(patterns)]
+            try:
+                self._rules_re = re.compile("|".join(
+                    f"(?P<_rule{i}>{p})" for i, p in enumerate(patterns)))
+            except re.error:
+                pass
+            else:
+                groupindex = self._rules_re.groupindex
+                self._rules_by_group = {
+                    groupindex[f"_rule{i}"]: rule
+                    for i, rule in enumerate(rules)}
 
     def _get_rule_by_event(self, event):
+        pathname = event.pathname
+        if self._rules_re is not None:
+            match = self._rules_re.match(pathname)
+            if match is None:
+                return None
+
+            # the renamed groups may differ from the rule's expression
+            # (e.g. within character classes), confirm the matching rule
+            rule = self._rules_by_group[match.lastindex]
+            if rule.src_re.match(pathname):
+                return rule
+
         rule = None
         for r in self._rules:
-            if r.src_re.match(event.pathname):
+            if r.src_re.match(pathname):
                 rule = r
                 break
 
         return rule
 
-    async def process_event(self, event):
-        if not ((not event.dir and self._files) or
-                (event.dir and self._dirs)):
-            return
+    def submit(self, event):
+        is_dir = event.dir
+        if not ((not is_dir and self._files) or (is_dir and self._dirs)):
+            return None
 
         if self._get_rule_by_event(event):
-            await super().process_event(event)
-        else:
-            logger = SchedulerLogger(self._log, {"event": event})
-            logger.debug("no rule in ruleset matches")
+            return super().submit(event)
+
+        logger = SchedulerLogger(self._log, {"event": event})
+        logger.debug("no rule in ruleset matches")
+        return None
+
+    async def shutdown(self, timeout=None):
+        await super().shutdown(timeout)
 
-    async def _chmod_and_chown(self, path, mode, chown, logger=None):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs))
+
+    def _chmod_and_chown(self, path, mode, chown, logger=None, dir_fd=None):
         logger = (logger or self._log)
 
         if mode is not None:
-            logger.debug(f"chmod {oct(mode)}")
-            os.chmod(path, mode)
+            logger.debug("chmod %#o", mode)
+            os.chmod(path, mode, dir_fd=dir_fd)
 
         if chown is not None:
-            changes = ""
-            if chown[0] is not None:
-                changes = chown[0]
+            if logger.isEnabledFor(logging.DEBUG):
+                changes = ""
+                if chown[0] != -1:
+                    changes = chown[0]
 
-            if chown[1] is not None:
-                changes = f"{changes}:{chown[1]}"
+                if chown[1] != -1:
+                    changes = f"{changes}:{chown[1]}"
 
-            logger.debug(f"chown {changes}")
-            shutil.chown(path, *chown)
+                logger.debug("chown %s", changes)
 
-    async def _set_mode_and_owner(self, path, rule, logger=None):
-        logger = (logger or self._log)
+            os.chown(path, *chown, dir_fd=dir_fd)
 
+    @staticmethod
+    def _chown_args(rule):
         if (rule.user is rule.group is None):
-            chown = None
-        else:
-            chown = (rule.user, rule.group)
+            return None
+
+        return (rule.uid, rule.gid)
+
+    def _create_dirs(self, path, rule, logger=None):
+        logger = (logger or self._log)
+
+        missing = []
+        while not os.path.isdir(path):
+            missing.append(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
 
-        if os.path.isdir(path):
+            path = parent
+
+        if not missing:
+            return
+
+        logger.info("create directory '%s'", missing[0])
+
+        # create the missing directories top-down and set mode and owner
+        # right away, instead of os.makedirs() and walking the new tree
+        chown = self._chown_args(rule)
+        for path in reversed(missing):
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                if not os.path.isdir(path):
+                    raise
+
+                continue
+
+            self._chmod_and_chown(path, rule.dirmode, chown, logger)
+
+    def _set_mode_and_owner(self, path, rule, logger=None, is_dir=None):
+        logger = (logger or self._log)
+
+        chown = self._chown_args(rule)
+
+        if rule.dirmode is rule.filemode is chown is None:
+            return
+
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+
+        if is_dir:
             mode = rule.dirmode
         else:
             mode = rule.filemode
 
-        await self._chmod_and_chown(path, mode, chown, logger)
+        self._chmod_and_chown(path, mode, chown, logger)
 
-        if not os.path.isdir(path):
+        if not is_dir:
             return
 
         work_on_dirs = not (rule.dirmode is chown is None)
         work_on_files = not (rule.filemode is chown is None)
 
         if work_on_dirs or work_on_files:
-            for root, dirs, files in os.walk(path):
+            for root, dirs, files, root_fd in os.fwalk(path):
                 if work_on_dirs:
-                    for p in [os.path.join(root, d) for d in dirs]:
-                        await self._chmod_and_chown(
-                            p, rule.dirmode, chown, logger)
+                    for d in dirs:
+                        self._chmod_and_chown(
+                            d, rule.dirmode, chown, logger, root_fd)
 
                 if work_on_files:
-                    for p in [os.path.join(root, f) for f in files]:
-                        await self._chmod_and_chown(
-                            p, rule.filemode, chown, logger)
+                    for f in files:
+                        self._chmod_and_chown(
+                            f, rule.filemode, chown, logger, root_fd)
 
     async def _manager_job(self, event, task_id):
         rule = self._get_rule_by_event(event)
@@ -382,6 +846,12 @@ class FileManagerScheduler(TaskScheduler):
 
         try:
             path = event.pathname
+            # inotify flags events of directories, no need to stat path
+            # unless it may be a symlink to a directory, which is copied
+            # as a directory
+            is_dir = event.dir
+            if not is_dir and rule.action == "copy":
+                is_dir = os.path.isdir(path)
             if rule.action in ["copy", "move"]:
                 dst = rule.src_re.sub(rule.dst_re, path)
                 if not dst:
@@ -389,56 +859,62 @@ class FileManagerScheduler(TaskScheduler):
                         f"unable to {rule.action} '{path}', "
                         f"resulting destination path is empty")
 
-                if os.path.exists(dst) and not rule.overwrite:
+                # moves without overwrite fail atomically on rename
+                if not rule.overwrite and rule.action == "copy" and \
+                        os.path.exists(dst):
                     raise RuntimeError(
                         f"unable to {rule.action} file from '{path} "
                         f"to '{dst}', path already exists")
 
-                dst_dir = os.path.dirname(dst)
-                if not os.path.isdir(dst_dir) and rule.auto_create:
-                    logger.info(f"create directory '{dst_dir}'")
-                    first_subdir = dst_dir
-                    while not os.path.isdir(first_subdir):
-                        parent = os.path.dirname(first_subdir)
-                        if not os.path.isdir(parent):
-                            first_subdir = parent
-                        else:
-                            break
-
+                if rule.auto_create:
                     try:
-                        os.makedirs(dst_dir)
-                        await self._set_mode_and_owner(
-                            first_subdir, rule, logger)
+                        await self._run_in_executor(
+                            self._create_dirs, os.path.dirname(dst), rule,
+                            logger)
                     except Exception as e:
                         raise RuntimeError(e)
 
-                logger.info(f"{rule.action} '{path}' to '{dst}'")
+                logger.info("%s '%s' to '%s'", rule.action, path, dst)
 
                 try:
                     if rule.action == "copy":
-                        if os.path.isdir(path):
-                            shutil.copytree(path, dst)
+                        if is_dir:
+                            await self._run_in_executor(
+                                shutil.copytree, path, dst,
+                                copy_function=_copy2)
                         else:
-                            shutil.copy2(path, dst)
+                            await self._run_in_executor(_copy2, path, dst)
 
                     else:
-                        os.rename(path, dst)
-
-                    await self._set_mode_and_owner(dst, rule, logger)
+                        if rule.overwrite:
+                            await self._run_in_executor(
+                                os.rename, path, dst)
+                        else:
+                            try:
+                                await self._run_in_executor(
+                                    _rename_noreplace, path, dst)
+                            except FileExistsError:
+                                raise RuntimeError(
+                                    f"unable to {rule.action} file from "
+                                    f"'{path} to '{dst}', path already "
+                                    f"exists")
+
+                    await self._run_in_executor(
+                        self._set_mode_and_owner, dst, rule, logger, is_dir)
                 except Exception as e:
                     raise RuntimeError(e)
 
             elif rule.action == "delete":
-                logger.info(f"{rule.action} '{path}'")
+                logger.info("%s '%s'", rule.action, path)
                 try:
-                    if os.path.isdir(path):
+                    if is_dir:
                         if rule.rec:
-                            shutil.rmtree(path)
+                            await self._run_in_executor(shutil.rmtree, path)
                         else:
-                            shutil.rmdir(path)
+                            await self._run_in_executor(os.rmdir, path)
 
                     else:
-                        os.remove(path)
+                        await self._run_in_executor(os.remove, path)
                 except Exception as e:
                     raise RuntimeError(e)
 
@@ -32,5 +32,6 @@ setup(name = "pyinotifyd",
         ]
     },
     install_requires = ["pyinotify"],
+    extras_require = {"uvloop": ["uvloop"]},
     python_requires = ">=3.7"
 )